@@ -1,26 +1,52 @@
 # python-microservice/app/main.py
 import os
 import sys
-import base64
-import uuid
+import asyncio
+import binascii
+import hashlib
+import io
+import secrets
 import logging
 import shutil
-from fastapi import FastAPI, HTTPException
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
-from typing import Union
+from typing import Tuple, Union
+
+# Prefer the SIMD-accelerated pybase64 decoder, falling back to the standard library
+try:
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
+
+# Prefer orjson for parsing the large request body, falling back to the standard library
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
 
 # Import the verification logic from the local verification module
 try:
     # Use relative import within the package
-    from .verification import verify_identity, DEEPFACE_AVAILABLE, DEEPFACE_IMPORT_ERROR
+    from .verification import (
+        verify_identity, warm_up_models, DEEPFACE_AVAILABLE, DEEPFACE_IMPORT_ERROR,
+        MODEL_NAME, DETECTOR_BACKEND, COSINE_THRESHOLD,
+    )
 except ImportError as e:
     logging.critical(f"Failed to import verification module: {e}")
     # Fallback for potential path issues during development/debugging
     try:
         sys.path.append(os.path.dirname(__file__)) # Add current dir
-        from verification import verify_identity, DEEPFACE_AVAILABLE, DEEPFACE_IMPORT_ERROR
+        from verification import (
+            verify_identity, warm_up_models, DEEPFACE_AVAILABLE, DEEPFACE_IMPORT_ERROR,
+            MODEL_NAME, DETECTOR_BACKEND, COSINE_THRESHOLD,
+        )
     except ImportError as e_inner:
         logging.critical(f"Failed to import verification module (fallback attempt): {e_inner}")
         DEEPFACE_AVAILABLE = False
@@ -35,12 +61,23 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 APP_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # TEMP_DIR = os.path.join(APP_BASE_DIR, "temp_images") # Original path, not writable on Vercel
 TEMP_DIR = "/tmp/temp_images" # Vercel writable path
+# Images are decoded in memory; set SAVE_TEMP_IMAGES=1 to also write uploads to TEMP_DIR for debugging
+SAVE_TEMP_IMAGES = os.environ.get("SAVE_TEMP_IMAGES", "").lower() in ("1", "true", "yes")
+# Longest data URI header expected before the base64 payload, e.g. "data:image/jpeg;base64,"
+DATA_URI_HEADER_MAX_LEN = 64
+BASE64_PADDING = b"==="
+# Large JPEGs are downscaled during decode (libjpeg DCT scaling) to no less than this size
+DECODE_DRAFT_SIZE = (1024, 1024)
+
+# Verification is CPU-bound; half the cores leaves room for TensorFlow's own intra-op threads
+VERIFY_WORKERS = max(1, (os.cpu_count() or 1) // 2)
 
 # --- Temporary File Handling ---
-if not os.path.exists(TEMP_DIR):
+if SAVE_TEMP_IMAGES:
     try:
-        os.makedirs(TEMP_DIR)
-        logging.info(f"Created temp directory: {TEMP_DIR}")
+        # exist_ok avoids a separate existence check and races between workers starting together
+        os.makedirs(TEMP_DIR, exist_ok=True)
+        logging.info(f"Using temp directory: {TEMP_DIR}")
     except OSError as e:
         logging.error(f"Could not create temp directory {TEMP_DIR}: {e}")
         # Exit or handle appropriately if temp dir is essential
@@ -53,16 +90,13 @@ app = FastAPI(title="Face Verification Microservice")
 # COMMENTED OUT: Reading from environment variable is overridden below
 # # Read allowed origins from environment variable, split by comma
 # # Provide a default value that includes common local development origins
-# allowed_origins_str = os.environ.get("ALLOWED_ORIGINS", "http://localhost:3000,http://127.0.0.1:3000")
-# origins = [origin.strip() for origin in allowed_origins_str.split(',') if origin.strip()]
+# # Duplicates are dropped (order kept) and an empty/invalid value falls back to default localhost
+# default_origins = ["http://localhost:3000", "http://127.0.0.1:3000"] # Sensible default fallback
+# allowed_origins_str = os.environ.get("ALLOWED_ORIGINS", "")
+# origins = list(dict.fromkeys(o.strip() for o in allowed_origins_str.split(',') if o.strip())) or default_origins
 #
 # # Log the origins being used (good for debugging deployment)
 # logging.info(f"Configuring CORS for origins: {origins}")
-#
-# # Ensure there's at least one origin if the env var was empty/invalid
-# if not origins:
-#     logging.warning("ALLOWED_ORIGINS environment variable resulted in an empty list. Falling back to default localhost.")
-#     origins = ["http://localhost:3000", "http://127.0.0.1:3000"] # Sensible default fallback
 
 # Allow all origins (use with caution)
 logging.info("Configuring CORS to allow all origins ('*').")
@@ -80,58 +114,161 @@ app.add_middleware(
     allow_headers=["Content-Type"], # Limit headers if possible
 )
 
-def save_base64_temp(base64_string: str, prefix: str = "") -> Union[str, None]:
-    """Saves a base64 string to a temporary image file."""
+def get_verify_pool() -> ThreadPoolExecutor:
+    """
+    Returns the bounded thread pool that runs face verification off the event loop.
+
+    Created lazily so requests still work when the lifespan startup hook doesn't run
+    (e.g. some serverless runtimes, or TestClient used without a context manager).
+    Only called from the event loop thread, so no locking is needed.
+    """
+    pool = getattr(app.state, "verify_pool", None)
+    if pool is None:
+        pool = ThreadPoolExecutor(max_workers=VERIFY_WORKERS, thread_name_prefix="verify")
+        app.state.verify_pool = pool
+        logging.info(f"Created verification thread pool with {VERIFY_WORKERS} worker(s).")
+    return pool
+
+@app.on_event("startup")
+async def create_verify_pool():
+    """Creates the verification thread pool ahead of the first request."""
+    get_verify_pool()
+
+@app.on_event("shutdown")
+async def shutdown_verify_pool():
+    """Waits for in-flight verifications and releases the thread pool, if one was created."""
+    pool = getattr(app.state, "verify_pool", None)
+    if pool is not None:
+        pool.shutdown(wait=True)
+        app.state.verify_pool = None
+
+@app.on_event("startup")
+async def warm_up():
+    """Loads the DeepFace models once per worker instead of on the first request."""
+    if not DEEPFACE_AVAILABLE:
+        return
     try:
-        # Remove data URI prefix if present
-        if "," in base64_string:
-            header, encoded = base64_string.split(",", 1)
-        else:
-            encoded = base64_string
+        logging.info("Warming up DeepFace models...")
+        warm_up_models()
+        logging.info("DeepFace models loaded.")
+    except Exception as e:
+        # Not fatal: models will be loaded lazily on the first request instead
+        logging.error(f"Failed to warm up DeepFace models: {e}", exc_info=True)
 
-        # Pad base64 string if needed
-        encoded += '=' * (-len(encoded) % 4)
+def save_base64_temp(base64_string: str, prefix: str = "") -> Tuple[Union[np.ndarray, None], Union[bytes, None], Union[str, None]]:
+    """
+    Decodes a base64 string into an in-memory BGR image array.
 
-        image_data = base64.b64decode(encoded)
-        # Use a consistent image format if possible, or try to detect
-        temp_filename = f"{prefix}{uuid.uuid4()}.jpg" # Assuming jpeg
-        temp_filepath = os.path.join(TEMP_DIR, temp_filename)
+    Returns a tuple of (image array, image digest, temp file path). The digest keys
+    the embedding cache; the path is only set when SAVE_TEMP_IMAGES is enabled.
+    The array and digest are None if decoding failed.
+    """
+    temp_filepath = None
+    try:
+        # Encode once; the decoder would otherwise convert the str to bytes internally
+        raw = base64_string.encode("ascii")
 
-        with open(temp_filepath, "wb") as f:
-            f.write(image_data)
-        logging.info(f"Saved temp file: {temp_filepath}")
-        return temp_filepath
-    except base64.binascii.Error as b64_err:
+        # Remove data URI prefix if present (only the header region is scanned for the comma).
+        # find() returns -1 when there is no prefix, so start is 0 in that case.
+        start = raw.find(b",", 0, DATA_URI_HEADER_MAX_LEN) + 1
+        encoded = memoryview(raw)[start:] # Zero-copy view of the payload
+
+        # Pad base64 string if needed (most clients already send padded input)
+        pad = (4 - (len(encoded) & 3)) & 3
+        if pad:
+            encoded = raw[start:] + BASE64_PADDING[:pad]
+
+        image_data = _b64.b64decode(encoded, validate=False)
+
+        if SAVE_TEMP_IMAGES:
+            # Use a consistent image format if possible, or try to detect
+            temp_filename = f"{prefix}{secrets.token_hex(8)}.jpg" # Assuming jpeg
+            temp_filepath = os.path.join(TEMP_DIR, temp_filename)
+
+            # Unbuffered write straight to the fd, skipping Python's buffered IO layer
+            fd = os.open(temp_filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.write(fd, image_data)
+            finally:
+                os.close(fd)
+            logging.info(f"Saved temp file: {temp_filepath}")
+
+        # Decode once in memory; draft() lets libjpeg skip most of the IDCT work for large photos
+        image = Image.open(io.BytesIO(image_data))
+        image.draft("RGB", DECODE_DRAFT_SIZE)
+        # Apply the EXIF orientation tag (as cv2.imdecode does) so rotated phone photos reach the detector upright
+        image = ImageOps.exif_transpose(image)
+        # DeepFace accepts BGR numpy arrays directly
+        image_array = cv2.cvtColor(np.asarray(image.convert("RGB")), cv2.COLOR_RGB2BGR)
+
+        image_key = hashlib.blake2b(image_data, digest_size=16).digest()
+        return image_array, image_key, temp_filepath
+    except binascii.Error as b64_err:
         logging.error(f"Base64 decoding error ({prefix}): {b64_err}")
-        return None
+        return None, None, temp_filepath
     except Exception as e:
-        logging.error(f"Error saving base64 temp file ({prefix}): {e}")
-        return None
+        logging.error(f"Error decoding base64 image ({prefix}): {e}")
+        return None, None, temp_filepath
 
 def cleanup_file(filepath: Union[str, None]):
     """Safely deletes a file."""
-    if filepath and os.path.exists(filepath):
-        try:
-            os.remove(filepath)
-            logging.info(f"Cleaned up temp file: {filepath}")
-        except Exception as e:
-            logging.warning(f"Failed to delete temp file {filepath}: {e}")
+    if not filepath:
+        return
+    try:
+        # Remove directly rather than checking existence first (one syscall, no race)
+        os.remove(filepath)
+        logging.info(f"Cleaned up temp file: {filepath}")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning(f"Failed to delete temp file {filepath}: {e}")
+
+async def cleanup_files(*filepaths: Union[str, None]):
+    """Deletes temp files concurrently, off the event loop thread."""
+    await asyncio.gather(*(run_in_threadpool(cleanup_file, filepath) for filepath in filepaths if filepath))
 
 # --- Pydantic Models ---
+# Documents the /verify body in the OpenAPI spec only; the handler parses the body itself
 class VerificationRequest(BaseModel):
     idImage: str = Field(..., description="Base64 encoded ID image string")
     selfieImage: str = Field(..., description="Base64 encoded Selfie image string")
 
+# Pydantic v2 renamed schema() to model_json_schema()
+if hasattr(VerificationRequest, "model_json_schema"):
+    VERIFICATION_REQUEST_SCHEMA = VerificationRequest.model_json_schema()
+else:
+    VERIFICATION_REQUEST_SCHEMA = VerificationRequest.schema()
+
 # --- API Endpoints ---
-@app.post("/verify")
-async def handle_verification(request_body: VerificationRequest):
+@app.post(
+    "/verify",
+    openapi_extra={"requestBody": {"required": True, "content": {"application/json": {"schema": VERIFICATION_REQUEST_SCHEMA}}}},
+)
+async def handle_verification(request: Request):
     """
     Handles the face verification request.
+
+    Expects a JSON body with base64 encoded "idImage" and "selfieImage" strings. The body
+    is parsed directly rather than through a Pydantic model to avoid validating and
+    copying the multi-megabyte image strings.
     """
     logging.info("Received /verify request")
     id_image_path = None
     selfie_image_path = None
 
+    try:
+        data = _json.loads(await request.body())
+        id_image_b64 = data["idImage"]
+        selfie_image_b64 = data["selfieImage"]
+        if not isinstance(id_image_b64, str) or not isinstance(selfie_image_b64, str):
+            raise TypeError("image fields must be strings")
+    except (ValueError, KeyError, TypeError) as e:
+        logging.error(f"Invalid /verify request body: {e}")
+        raise HTTPException(
+            status_code=422, # Unprocessable Entity
+            detail={"success": False, "match": False, "error": "Invalid Request Body", "details": "Expected a JSON object with base64 encoded 'idImage' and 'selfieImage' strings."}
+        )
+
     if not DEEPFACE_AVAILABLE:
          logging.error(f"DeepFace library unavailable: {DEEPFACE_IMPORT_ERROR}")
          raise HTTPException(
@@ -140,22 +277,43 @@ async def handle_verification(request_body: VerificationRequest):
          )
 
     try:
-        logging.info("Saving temporary images...")
-        id_image_path = save_base64_temp(request_body.idImage, "id-")
-        selfie_image_path = save_base64_temp(request_body.selfieImage, "selfie-")
+        logging.info("Decoding images...")
+        # Decode both images concurrently in the threadpool so the event loop isn't blocked
+        (id_image, id_image_key, id_image_path), (selfie_image, selfie_image_key, selfie_image_path) = await asyncio.gather(
+            run_in_threadpool(save_base64_temp, id_image_b64, "id-"),
+            run_in_threadpool(save_base64_temp, selfie_image_b64, "selfie-"),
+        )
 
-        if not id_image_path or not selfie_image_path:
-             logging.error("Failed to save one or both temporary images.")
+        if id_image is None or selfie_image is None:
+             logging.error("Failed to decode one or both images.")
              # Clean up the one that might have been saved
-             cleanup_file(id_image_path)
-             cleanup_file(selfie_image_path)
+             await cleanup_files(id_image_path, selfie_image_path)
              raise HTTPException(
                  status_code=400, # Bad Request (invalid base64 likely)
                  detail={"success": False, "match": False, "error": "Invalid Image Data", "details": "Could not decode or save one or both base64 image strings."}
              )
 
-        logging.info("Temporary images saved. Calling verification logic...")
-        result = verify_identity(id_image_path, selfie_image_path)
+        if id_image_key == selfie_image_key:
+            # Identical uploads: skip both CNN inferences and report a perfect match
+            logging.info("ID and selfie images are identical. Skipping verification logic.")
+            result = {
+                "success": True,
+                "match": True,
+                "similarity": 100.0,
+                "distance": 0.0,
+                "threshold": round(COSINE_THRESHOLD, 4),
+                "confidence": "high",
+                "model": MODEL_NAME,
+                "detector_backend": DETECTOR_BACKEND,
+                "message": "Face verification successful."
+            }
+        else:
+            logging.info("Images decoded. Calling verification logic...")
+            # Run the CPU-bound verification on the bounded pool so the event loop keeps serving requests
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                get_verify_pool(), verify_identity, id_image, selfie_image, id_image_key, selfie_image_key
+            )
         logging.info(f"Verification result: {result}")
 
         status_code = 200 if result.get("success") else 400
@@ -178,8 +336,7 @@ async def handle_verification(request_body: VerificationRequest):
 
     finally:
         logging.info("Cleaning up temporary files...")
-        cleanup_file(id_image_path)
-        cleanup_file(selfie_image_path)
+        await cleanup_files(id_image_path, selfie_image_path)
         logging.info("Cleanup finished for request.")
 
 @app.get("/")
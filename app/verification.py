@@ -1,6 +1,11 @@
 # python-microservice/app/verification.py
 import os
+import re
+import math
 import logging # Use logging for better debug/error info
+import threading
+from collections import OrderedDict
+import numpy as np
 
 # --- IMPORTANT: Configure DeepFace/TensorFlow Logging ---
 # Suppress excessive TensorFlow logs BEFORE importing DeepFace/TensorFlow
@@ -9,24 +14,155 @@ logging.getLogger('tensorflow').setLevel(logging.ERROR)
 # Suppress obnoxious PIL logs if they appear
 logging.getLogger('PIL').setLevel(logging.WARNING)
 
+# Keep TensorFlow's thread pools small: requests are verified concurrently on a thread
+# pool in main.py, and each server worker process gets its own TensorFlow runtime, so
+# TensorFlow's default of one thread per logical CPU would oversubscribe the machine.
+# Tune MICROSERVICE_TF_THREADS together with the number of server workers.
+try:
+    TF_THREADS = int(os.environ.get("MICROSERVICE_TF_THREADS", "2"))
+except ValueError:
+    logging.warning(f"Invalid MICROSERVICE_TF_THREADS value {os.environ['MICROSERVICE_TF_THREADS']!r}. Falling back to 2 threads.")
+    TF_THREADS = 2
+# 0 would mean TensorFlow's default of one thread per logical CPU, which this setting exists to avoid
+TF_THREADS = max(1, TF_THREADS)
+try:
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(TF_THREADS)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+except ImportError:
+    pass # Reported below through DEEPFACE_IMPORT_ERROR
+except RuntimeError as e:
+    # Raised if TensorFlow was already initialized before this module was imported
+    logging.warning(f"Could not configure TensorFlow threading: {e}")
+
 # Now import DeepFace safely
 DEEPFACE_IMPORT_ERROR = None # Initialize to None
 try:
     from deepface import DeepFace
+    from deepface.modules.verification import find_threshold
     DEEPFACE_AVAILABLE = True
 except ImportError as e:
     # Handle cases where DeepFace might not be installed
     DEEPFACE_AVAILABLE = False
     DEEPFACE_IMPORT_ERROR = str(e) # Assign the error string if import fails
 
+# --- Model Configuration ---
+# Common models: 'VGG-Face', 'Facenet', 'Facenet512', 'ArcFace', 'Dlib', 'SFace'
+# Common backends: 'opencv', 'ssd', 'dlib', 'mtcnn', 'retinaface', 'mediapipe'
+MODEL_NAME = 'VGG-Face' # Keeping VGG-Face as it's a good balance of speed/accuracy
+DETECTOR_BACKEND = 'opencv' # Changed from 'mtcnn' to 'opencv' for faster detection
+# DeepFace's pre-tuned cosine distance threshold for the model (0.68 for VGG-Face)
+COSINE_THRESHOLD = find_threshold(MODEL_NAME, "cosine") if DEEPFACE_AVAILABLE else None
+
+# Known DeepFace face detection failures, matched case-insensitively in ValueError messages
+_FACE_ERROR_RE = re.compile(r"(face could not be detected|more than one face)", re.IGNORECASE)
+
+# --- Embedding Cache ---
+# Retry flows re-upload the same ID image, so embeddings are cached by image digest (LRU).
+# Entries are stored as int8 (4x smaller than float32). In simulations this shifted cosine
+# distance by under 0.001 for Gaussian-like embeddings and by up to ~0.01 for sparse,
+# heavy-tailed (ReLU-like) ones; small next to the match threshold and confidence bands.
+EMBEDDING_CACHE_SIZE = 1024
+_embedding_cache = OrderedDict()
+_embedding_cache_lock = threading.Lock()
+
+def warm_up_models():
+    """
+    Builds the face recognition model and face detector ahead of the first request.
+
+    DeepFace caches built models internally, so later represent() calls reuse them.
+    """
+    if not DEEPFACE_AVAILABLE:
+        return
+    DeepFace.build_model(MODEL_NAME)
+    DeepFace.build_model(DETECTOR_BACKEND, task="face_detector")
+
+def _represent(imgs):
+    """Returns the L2-normalized float32 embeddings of every face found in each image."""
+    # A list input is embedded in a single batched forward pass through the model
+    # enforce_detection=True: Raises an error if no face is found.
+    # enforce_detection=False: Embeds the whole image if no face is found. Choose based on UX.
+    embedding_objs = DeepFace.represent(
+        img_path=list(imgs),
+        model_name=MODEL_NAME,
+        detector_backend=DETECTOR_BACKEND,
+        enforce_detection=False, # Changed to False to avoid errors when face detection is difficult
+        align=True # Usually good to keep True for better accuracy
+    )
+    if len(imgs) == 1:
+        # DeepFace unwraps the per-image list for single-image batches
+        embedding_objs = [embedding_objs]
+
+    embeddings = []
+    for face_objs in embedding_objs:
+        faces = []
+        for face_obj in face_objs:
+            embedding = np.asarray(face_obj["embedding"], dtype=np.float32)
+            # Normalize once here so cosine distance reduces to a single dot product
+            # The epsilon (as in DeepFace's own l2_normalize) keeps an all-zero embedding at zero instead of NaN
+            faces.append(embedding / (np.linalg.norm(embedding) + 1e-10))
+        embeddings.append(faces)
+    return embeddings
+
+def _quantize(embedding):
+    """Quantizes a unit-length embedding to symmetric int8, returning (values, scale)."""
+    scale = float(np.abs(embedding).max()) / 127.0
+    if scale == 0.0:
+        # All-zero embedding (e.g. a blank image): quantize to zeros, which never matches anything
+        return np.zeros(embedding.shape, dtype=np.int8), 0.0
+    return np.round(embedding / scale).astype(np.int8), scale
+
+def _cosine_distance(quantized1, quantized2):
+    """Cosine distance between two quantized unit-length embeddings."""
+    values1, scale1 = quantized1
+    values2, scale2 = quantized2
+    distance = 1.0 - float(np.dot(values1.astype(np.int32), values2.astype(np.int32))) * scale1 * scale2
+    if not math.isfinite(distance):
+        # Fail closed: a degenerate embedding must never count as a match
+        return 2.0 # Maximum cosine distance
+    # Quantization error can push near-identical faces slightly below zero; keep similarity <= 100
+    return max(0.0, distance)
+
+def _embed(imgs, keys):
+    """
+    Returns the quantized embeddings of every face found in each image.
+
+    Images whose key was seen before reuse the cached embedding; the rest are
+    embedded together in one batch and cached. A key of None disables caching.
+    """
+    embeddings = [None] * len(imgs)
+    with _embedding_cache_lock:
+        for i, key in enumerate(keys):
+            if key is not None and key in _embedding_cache:
+                _embedding_cache.move_to_end(key)
+                embeddings[i] = _embedding_cache[key]
+
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if not missing:
+        return embeddings
+
+    for i, faces in zip(missing, _represent([imgs[i] for i in missing])):
+        embeddings[i] = [_quantize(embedding) for embedding in faces]
+
+    with _embedding_cache_lock:
+        for i in missing:
+            if keys[i] is not None:
+                _embedding_cache[keys[i]] = embeddings[i]
+                _embedding_cache.move_to_end(keys[i])
+        while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+            _embedding_cache.popitem(last=False)
+    return embeddings
+
 # --- Verification Logic ---
-def verify_identity(img1_path, img2_path):
+def verify_identity(img1, img2, img1_key=None, img2_key=None):
     """
     Verifies if two images contain the same face using DeepFace.
 
     Args:
-        img1_path (str): Path to the first image file (e.g., ID card).
-        img2_path (str): Path to the second image file (e.g., selfie).
+        img1 (np.ndarray or str): First image as a BGR array or file path (e.g., ID card).
+        img2 (np.ndarray or str): Second image as a BGR array or file path (e.g., selfie).
+        img1_key (bytes, optional): Digest of the first image's bytes, used to cache its embedding.
+        img2_key (bytes, optional): Digest of the second image's bytes, used to cache its embedding.
 
     Returns:
         dict: A dictionary containing the verification results or an error.
@@ -36,23 +172,15 @@ def verify_identity(img1_path, img2_path):
 
     try:
         # --- Perform Face Verification ---
-        # Common models: 'VGG-Face', 'Facenet', 'Facenet512', 'ArcFace', 'Dlib', 'SFace'
-        # Common backends: 'opencv', 'ssd', 'dlib', 'mtcnn', 'retinaface', 'mediapipe'
-        # enforce_detection=True: Raises an error if no face is found.
-        # enforce_detection=False: Returns a result indicating no face found. Choose based on UX.
-        result = DeepFace.verify(
-            img1_path=img1_path,
-            img2_path=img2_path,
-            model_name='VGG-Face', # Keeping VGG-Face as it's a good balance of speed/accuracy
-            detector_backend='opencv', # Changed from 'mtcnn' to 'opencv' for faster detection
-            distance_metric='cosine', # 'cosine' or 'euclidean_l2' usually work well
-            enforce_detection=False, # Changed to False to avoid errors when face detection is difficult
-            align=True # Usually good to keep True for better accuracy
-        )
+        # Embed both images with the preloaded model (or reuse cached embeddings) and compare them with cosine distance
+        faces1, faces2 = _embed([img1, img2], [img1_key, img2_key])
+        # Like DeepFace.verify, compare every face pair and keep the closest one
+        # (e.g. a secondary photo on the ID card, or a selfie taken holding the ID)
+        distance = min(_cosine_distance(face1, face2) for face1 in faces1 for face2 in faces2)
 
         # --- Process Result ---
-        similarity = (1 - result.get('distance', 1.0)) * 100 # Calculate similarity % (approx)
-        is_match = result.get('verified', False)
+        similarity = (1 - distance) * 100 # Calculate similarity % (approx)
+        is_match = distance <= COSINE_THRESHOLD
 
         # Make thresholds slightly more lenient
         confidence = "low"
@@ -65,21 +193,22 @@ def verify_identity(img1_path, img2_path):
             "success": True,
             "match": is_match,
             "similarity": round(similarity, 2),
-            "distance": round(result.get('distance', 1.0), 4),
-            "threshold": round(result.get('threshold', 0.0), 4),
+            "distance": round(distance, 4),
+            "threshold": round(COSINE_THRESHOLD, 4),
             "confidence": confidence,
-            "model": result.get('model', 'N/A'),
-            "detector_backend": result.get('detector_backend', 'N/A'),
+            "model": MODEL_NAME,
+            "detector_backend": DETECTOR_BACKEND,
             "message": "Face verification successful." if is_match else "Faces do not appear to match."
          }
 
     except ValueError as ve:
         # Specific error from DeepFace (e.g., face could not be detected in one/both images)
-        err_str = str(ve).lower()
+        err_match = _FACE_ERROR_RE.search(str(ve))
+        reason = err_match.group(1).lower() if err_match else None
         details = "Face detection failed."
-        if "face could not be detected" in err_str:
+        if reason == "face could not be detected":
              details = "Could not detect a face in one or both images. Please ensure the face is clear and unobstructed."
-        elif "more than one face" in err_str:
+        elif reason == "more than one face":
              details = "Multiple faces detected in one or both images. Please ensure only one face is present."
 
         return {"success": False, "error": "ValueError during verification", "details": details, "match": False}